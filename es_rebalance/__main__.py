@@ -1,17 +1,39 @@
 
 from elasticsearch6 import Elasticsearch
-from elasticsearch6.exceptions import TransportError
+from elasticsearch6.exceptions import SerializationError
+from elasticsearch6.serializer import JSONSerializer
 import argparse
-import json
 import logging
-import pprint
-import re
-import statistics
+
+try:
+	import orjson
+except ImportError:
+	orjson = None
 
 from es_rebalance import *
 
 LOG = logging.getLogger(__name__)
 
+class OrjsonSerializer(JSONSerializer):
+	"""
+	Serializer for the ES client that uses orjson, which decodes the large cat responses much faster
+	than the standard library. Only used if orjson is installed.
+	"""
+	def dumps(self, data):
+		# Don't serialize strings, same as JSONSerializer
+		if isinstance(data, str):
+			return data
+		try:
+			return orjson.dumps(data).decode("utf-8")
+		except TypeError as err:
+			raise SerializationError(data, err)
+	
+	def loads(self, s):
+		try:
+			return orjson.loads(s)
+		except ValueError as err:
+			raise SerializationError(s, err)
+
 def main():
 	parser = argparse.ArgumentParser(
 		prog="es-rebalance",
@@ -39,26 +61,37 @@ Example:
 		help="Don't exchange shards whose sizes are within this percent of each other, to avoid swapping similar-sized shards.")
 	parser.add_argument("-P", "--node-percentage", type=float, default=10,
 		help="Don't exchange between nodes whose sizes are within this many percentage points of each other.")
+	parser.add_argument("--cache", metavar="DIR",
+		help="Cache cluster info in this directory and reuse it while the cluster state is unchanged. Useful for repeated dry runs. Shard sizes may be out of date, so this can't be used with --execute.")
+	parser.add_argument("--batch-size", type=int, metavar="N",
+		help="Submit the moves in concurrent requests of N exchanges each instead of a single request. Ignored for dry runs.")
 	parser.add_argument("-v", "--verbose", action="store_true",
 		help="Print debug logs.")
 	parser.add_argument("--execute", action="store_true",
 		help="Run the plan. If not specified, will be a dry run.")
 	
 	args = parser.parse_args()
+	if args.batch_size is not None and args.batch_size < 1:
+		parser.error("--batch-size must be at least 1")
+	if args.cache is not None and args.execute:
+		parser.error("--cache can't be used with --execute, since cached shard sizes may be out of date")
 	
 	logging.basicConfig(level=logging.INFO)
 	if args.verbose:
 		LOG.setLevel(logging.DEBUG)
 	
-	es = Elasticsearch(args.url)
+	if orjson is not None:
+		es = Elasticsearch(args.url, serializer=OrjsonSerializer())
+	else:
+		es = Elasticsearch(args.url)
 	
-	plan = Plan(es, args.box_type, args.shard_percentage, args.node_percentage)
+	plan = Plan(es, args.box_type, args.shard_percentage, args.node_percentage, cache_dir=args.cache)
 	for i in range(args.iterations):
 		if not plan.plan_step():
 			LOG.warn("Could not move anything, stopping early after %d iteration(s)", i+1)
 			break
 	
-	plan.exec(dry_run=not args.execute)
+	plan.exec(dry_run=not args.execute, batch_size=args.batch_size)
 	if not args.execute:
 		LOG.warn("Finished dry run. Use `--execute` to run for real.")
 
@@ -1,12 +1,15 @@
 
-from collections import namedtuple
-from elasticsearch6 import Elasticsearch
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from operator import attrgetter
 from elasticsearch6.exceptions import TransportError
 import json
 import logging
+import os
 import pprint
-import re
-import statistics
+import sys
+import tempfile
 
 LOG = logging.getLogger(__name__)
 
@@ -26,8 +29,10 @@ class NodeInfo:
 	* ip: str
 	* rack: str, rack name of the node for replication awareness
 	* capacity: int, in bytes
-	* shards: list of Shard, usually sorted largest-first. After editing call resort.
-	* used: int, in bytes. Calculated by resort.
+	* shards: list of Shard, sorted largest-first. Edit with `add_shard` and `remove_shard` to keep it sorted.
+	* used: int, in bytes. Total size of `shards`, kept up to date by `add_shard` and `remove_shard`.
+	* fraction_used: float, the fractional disk usage - ranging from 0 to 1 with 0 being empty and 1 being
+	  full. Kept up to date along with `used`.
 	"""
 	def __init__(self, name, ip, rack, capacity, shards):
 		# Immutable properties
@@ -38,52 +43,85 @@ class NodeInfo:
 		
 		# Mutable properties
 		# `shards` and `used` are updated during planning.
-		# `shards` is sorted by size (store)
+		# `shards` is sorted by size (store), and `_shard_keys` holds the negated sizes
+		# in the same order so that it can be bisected.
 		self.shards = shards
+		self._shard_keys = None
 		self.used = None
+		self.fraction_used = None
 		self.resort()
 	
-	@property
-	def fraction_used(self):
+	def add_shard(self, shard):
 		"""
-		Computes the fractional disk usage - a float ranging from 0 to 1 with 0 being
-		empty and 1 being full.
+		Adds a shard to the node, keeping `shards` sorted, and updates `used`.
 		"""
-		return self.used / self.capacity
+		i = bisect_right(self._shard_keys, -shard.store)
+		self._shard_keys.insert(i, -shard.store)
+		self.shards.insert(i, shard)
+		self.used += shard.store
+		self.fraction_used = self.used / self.capacity
+	
+	def remove_shard(self, shard):
+		"""
+		Removes a shard from the node and updates `used`.
+		"""
+		i = bisect_left(self._shard_keys, -shard.store)
+		while self.shards[i] is not shard:
+			i += 1
+		del self._shard_keys[i]
+		del self.shards[i]
+		self.used -= shard.store
+		self.fraction_used = self.used / self.capacity
 	
 	def resort(self):
 		"""
-		Sorts the `shards` list by size and updates `used`. Call after modifying `shards`.
+		Sorts the `shards` list by size and recomputes `used`. Only needed if `shards` was modified directly.
 		"""
-		self.shards.sort(key=lambda shard: shard.store, reverse=True)
-		self.used = sum(shard.store for shard in self.shards)
+		self.shards.sort(key=attrgetter("store"), reverse=True)
+		self._shard_keys = [-shard.store for shard in self.shards]
+		self.used = -sum(self._shard_keys)
+		self.fraction_used = self.used / self.capacity
 
-# Shard class
-# Namedtuple since it does not need any methods
-Shard = namedtuple("Shard", [
-	"index", # str, index name
-	"shard", # int, stard index
-	"prirep", # str, either "p" for primaries or "r" for replicas
-	"store", # int, size of shard in bytes
-	"can_move", # bool, can we move this shard? Can't be moved if relocating, in a bad state, etc
-])
+class Shard:
+	"""
+	Info about a copy of a shard on a node
+	
+	Fields:
+	
+	* index: str, index name
+	* shard: int, shard number
+	* prirep: str, either "p" for primaries or "r" for replicas
+	* store: int, size of shard in bytes
+	* can_move: bool, can we move this shard? Can't be moved if relocating, in a bad state, etc
+	* key: (index, shard) tuple, identifies the shard across its primary and replicas
+	"""
+	# Large clusters have many shards, so avoid a per-instance __dict__
+	__slots__ = ("index", "shard", "prirep", "store", "can_move", "key")
+	
+	def __init__(self, index, shard, prirep, store, can_move):
+		self.index = index
+		self.shard = shard
+		self.prirep = prirep
+		self.store = store
+		self.can_move = can_move
+		self.key = (index, shard)
+	
+	def __repr__(self):
+		return "Shard(index=%r, shard=%r, prirep=%r, store=%r, can_move=%r)" % (
+			self.index, self.shard, self.prirep, self.store, self.can_move)
 
-# Regex for parsing relocating nodes
-RELOCATING_RE = re.compile(r"^([^ ]+) -> [^ ]+ [^ ]+ ([^ ]+)$")
+# Units for format_bytes, each 1024 times the previous one
+BYTE_UNITS = ("B", "KiB", "MiB", "GiB", "TiB")
 
 def format_bytes(num_bytes):
 	"""
 	Formats a number into human-friendly byte units (KiB, MiB, etc)
 	"""
-	if num_bytes >= 1024*1024*1024*1024:
-		return "%.2fTiB" % (num_bytes / (1024*1024*1024*1024))
-	if num_bytes >= 1024*1024*1024:
-		return "%.2fGiB" % (num_bytes / (1024*1024*1024))
-	if num_bytes >= 1024*1024:
-		return "%.2fMiB" % (num_bytes / (1024*1024))
-	if num_bytes >= 1024:
-		return "%.2fKiB" % (num_bytes / (1024))
-	return "%dB" % num_bytes
+	# Each unit is 10 more bits, so the bit length picks the unit directly
+	scale = min(max(num_bytes.bit_length() - 1, 0) // 10, len(BYTE_UNITS) - 1)
+	if scale == 0:
+		return "%dB" % num_bytes
+	return "%.2f%s" % (num_bytes / (1 << (10 * scale)), BYTE_UNITS[scale])
 
 class Plan:
 	"""
@@ -98,29 +136,31 @@ class Plan:
 	  are within this fraction of each other.
 	* operations: list of dicts compatible with ES's reroute command. Pending operations.
 	* nodes_by_size: list of NodeInfo, sorted by percent used largest-first.
-	* moved_stards: set of Shard that have already been moved.
+	* moved_shards: set of Shard keys that have already been moved.
+	* rack_index: dict mapping (rack, index, shard number) to the set of node names on that rack holding
+	  a copy of that shard. Used to check the one-shard-per-rack rule.
+	* fraction_sum: float, sum of the fractional disk usage of all nodes. Used to compute variance changes.
 	"""
-	def __init__(self, es, box_type, shard_percentage_threshold, node_percentage_threshold):
+	def __init__(self, es, box_type, shard_percentage_threshold, node_percentage_threshold, cache_dir=None):
 		self.es = es
 		self.shard_fraction_threshold = 1 - shard_percentage_threshold / 100
 		self.node_fraction_threshold = node_percentage_threshold / 100
 		
-		# Grab node and shard info from ES
-		raw_alloc_infos = es.cat.allocation(format="json", bytes="b")
-		raw_shards = es.cat.shards(format="json", bytes="b")
-		raw_nodes = dict((node["name"], node) for node in es.nodes.info(format="json")["nodes"].values())
+		raw_alloc_infos, raw_shards, raw_nodes = self._fetch_cluster_info(cache_dir)
+		node_attributes = dict((node["name"], node["attributes"]) for node in raw_nodes["nodes"].values())
 		
 		# Make NodeInfo structs from nodes
 		nodes = {}
 		for alloc_info in raw_alloc_infos:
 			if alloc_info["node"] == "UNASSIGNED":
 				continue
-			if raw_nodes[alloc_info["node"]]["attributes"].get("box_type") != box_type:
+			attributes = node_attributes[alloc_info["node"]]
+			if attributes.get("box_type") != box_type:
 				continue
 			nodes[alloc_info["node"]] = NodeInfo(
 				name=alloc_info["node"],
 				ip=alloc_info["ip"],
-				rack=raw_nodes[alloc_info["node"]]["attributes"]["rack_id"],
+				rack=attributes["rack_id"],
 				capacity=int(alloc_info["disk.total"]),
 				shards=[],
 			)
@@ -128,8 +168,9 @@ class Plan:
 		# Fill out NodeInfo's shards list
 		for shard in raw_shards:
 			if shard["state"] == "RELOCATING":
-				match = RELOCATING_RE.match(shard["node"])
-				shard_nodes = (match.group(1), match.group(2))
+				# Node is formatted as "<from node> -> <to ip> <to id> <to node>"
+				parts = shard["node"].split(" ")
+				shard_nodes = (parts[0], parts[-1])
 			else:
 				shard_nodes = (shard["node"],)
 			
@@ -142,28 +183,83 @@ class Plan:
 				if node_name not in nodes:
 					continue
 				nodes[node_name].shards.append(Shard(
-					index=shard["index"],
+					# Many shards share an index name, so share the string too
+					index=sys.intern(shard["index"]),
 					shard=int(shard["shard"]),
 					prirep=shard["prirep"],
 					store=int(shard["store"]) if shard["store"] is not None else 0,
 					can_move=can_move,
 				))
 		
+		# Sort each node's shards once, rather than inserting them one at a time
+		for node in nodes.values():
+			node.resort()
+		
 		self.operations = []
 		self.nodes_by_size = list(nodes.values())
 		self.moved_shards = set()
+		self._movable_cache = {}
+		self.rack_index = defaultdict(set)
+		for node in self.nodes_by_size:
+			for shard in node.shards:
+				self.rack_index[(node.rack, shard.index, shard.shard)].add(node.name)
+		self.fraction_sum = sum(node.fraction_used for node in self.nodes_by_size)
 		self._sort()
 	
+	def _fetch_cluster_info(self, cache_dir=None):
+		"""
+		Gets the raw allocation, shard, and node info responses from ES.
+		
+		If `cache_dir` is given, the responses are saved there, keyed by the cluster state UUID, and
+		reused by later calls as long as the cluster state has not changed. Note that shard sizes can
+		change without the cluster state changing, so cached sizes may be somewhat out of date.
+		"""
+		cache_path = None
+		if cache_dir is not None:
+			state = self.es.cluster.state(metric="version")
+			cache_path = os.path.join(cache_dir, "%s.json" % state["state_uuid"])
+			try:
+				with open(cache_path) as f:
+					responses = tuple(json.load(f))
+				LOG.info("Using cached cluster info from %s", cache_path)
+				return responses
+			except FileNotFoundError:
+				pass
+			except ValueError:
+				LOG.warn("Ignoring unreadable cache file %s", cache_path)
+		
+		# The requests are independent, so run them concurrently.
+		with ThreadPoolExecutor(max_workers=3) as executor:
+			# Only request the columns/fields we use, to cut down on response size and parsing time
+			alloc_future = executor.submit(self.es.cat.allocation, format="json", bytes="b",
+				h="node,ip,disk.total")
+			shards_future = executor.submit(self.es.cat.shards, format="json", bytes="b",
+				h="index,shard,prirep,state,store,node")
+			nodes_future = executor.submit(self.es.nodes.info, format="json",
+				filter_path="nodes.*.name,nodes.*.attributes")
+			responses = (alloc_future.result(), shards_future.result(), nodes_future.result())
+		
+		if cache_path is not None:
+			# Write to a temporary file and move it into place, so an interrupted run can't leave a
+			# truncated cache file behind
+			os.makedirs(cache_dir, exist_ok=True)
+			with tempfile.NamedTemporaryFile("w", dir=cache_dir, suffix=".tmp", delete=False) as f:
+				try:
+					json.dump(responses, f)
+				except BaseException:
+					f.close()
+					os.remove(f.name)
+					raise
+			os.replace(f.name, cache_path)
+		return responses
+	
 	def _sort(self):
 		"""
-		Resorts all nodes and the `nodes_by_size` list.
+		Resorts the `nodes_by_size` list.
 		Call after modifying a node's shards list.
 		"""
-		for node in self.nodes_by_size:
-			node.resort()
-		self.nodes_by_size.sort(
-			key=lambda node: node.used / node.capacity,
-			reverse=True)
+		# Only a few nodes move per call, so this is close to linear for an already mostly sorted list
+		self.nodes_by_size.sort(key=attrgetter("fraction_used"), reverse=True)
 	
 	def plan_step(self):
 		"""
@@ -174,24 +270,14 @@ class Plan:
 		Returns true if a shard was able to be exchanged, or false if
 		no shards are able to exchange anymore.
 		"""
-		current_pvariance = self.percent_used_variance()
-		
 		for big_node, big_shard in self.find_big_shards():
-			for small_node, small_shard in self.find_small_shards(big_node):
-				# Is the "small" shard actually the smaller of the two?
-				if small_shard.store >= big_shard.store:
-					continue
-				
+			for small_node, small_shard in self.find_small_shards(big_node, big_shard):
 				# Can we even move this node?
 				if not self.can_exchange_shards(big_node, big_shard, small_node, small_shard):
 					continue
 				
 				# Make sure moving this actually makes things more even
-				exchanged_pvariance = self.percent_used_variance(
-					exclude_shards=((big_node, big_shard), (small_node, small_shard)),
-					include_shards=((small_node, big_shard), (big_node, small_shard)),
-				)
-				if exchanged_pvariance >= current_pvariance:
+				if self.exchange_variance_delta(big_node, big_shard, small_node, small_shard) >= 0:
 					continue
 				
 				self.plan_exchange(big_node, big_shard, small_node, small_shard)
@@ -210,116 +296,110 @@ class Plan:
 				# no way we can exchange anything. Stop.
 				break
 			
-			for shard in node.shards:
-				if (shard.index, shard.shard) in self.moved_shards:
-					continue
-				if not shard.can_move:
-					continue
+			for shard in self._movable_shards(node):
 				yield node, shard
 	
-	def find_small_shards(self, big_node):
+	def find_small_shards(self, big_node, big_shard):
 		"""
-		Yields small shards that ought to be exchanged, with the highest-priority shards first.
+		Yields small shards that ought to be exchanged with `big_shard`, with the highest-priority shards first.
 		
 		Prioritizes the opposite way that find_big_shards does: starts with smallest shards on most free hosts.
+		Skips shards that are too similar in size to `big_shard`, and nodes on racks `big_shard` can't move to.
 		"""
+		# Only consider "small" shards that are different enough in size to be worth swapping
+		max_store = big_shard.store * self.shard_fraction_threshold
+		
 		for node in reversed(self.nodes_by_size):
 			if node is big_node:
 				# We've met up with the big node. All other nodes will be bigger than it,
 				# so there's no point in continuing
 				break
+			if big_node.fraction_used - node.fraction_used < self.node_fraction_threshold:
+				# Node has a similar percent used as the big node, and the remaining nodes are
+				# even closer, so none of them can exchange with it. Stop.
+				break
+			if self._rack_conflict(big_shard, big_node, node.rack) is not None:
+				# The big shard can't be moved to this node's rack, so none of its shards will do
+				continue
 			
-			for shard in reversed(node.shards):
-				if (shard.index, shard.shard) in self.moved_shards:
-					continue
-				if not shard.can_move:
-					continue
+			for shard in reversed(self._movable_shards(node)):
+				if shard.store > max_store:
+					# Shards are sorted, so the rest of the node's shards are too big as well
+					break
 				yield node, shard
 	
+	def _movable_shards(self, node):
+		"""
+		Gets the shards on a node that can still be exchanged, largest-first.
+		
+		find_small_shards runs once per big shard, so the filtered lists are cached until the next exchange.
+		"""
+		shards = self._movable_cache.get(node)
+		if shards is None:
+			shards = [shard for shard in node.shards if shard.can_move and shard.key not in self.moved_shards]
+			self._movable_cache[node] = shards
+		return shards
+	
 	def can_exchange_shards(self, node1, node1_shard, node2, node2_shard):
 		"""
 		Checks if two shards can be exchanged, according to the setup rules for the plan, the node's available
 		disk space, and the one-replica-per-rack ES rule.
+		
+		Shard sizes are not compared here; `find_small_shards` only yields shards that are small enough.
 		"""
 		# Can't swap a node with itself
 		if node1 is node2:
 			return False
 		
-		# Is the swap large enough to be worth it?
-		if node1_shard.store > node2_shard.store:
-			size_fraction = node2_shard.store / node1_shard.store
-		else:
-			size_fraction = node1_shard.store / node2_shard.store
-		if size_fraction > self.shard_fraction_threshold:
-			LOG.debug("Not worth swapping: shard %s/%s/%s (%s) with shard %s/%s/%s (%s)",
-				node1_shard.index, node1_shard.shard, node1_shard.prirep,
-				format_bytes(node1_shard.store),
-				node2_shard.index, node2_shard.shard, node2_shard.prirep,
-				format_bytes(node2_shard.store),
-			)
-			return False
-		
 		# Are the two nodes too similar in disk utilization?
-		if abs(node1.used / node1.capacity - node2.used / node2.capacity) < self.node_fraction_threshold:
+		if abs(node1.fraction_used - node2.fraction_used) < self.node_fraction_threshold:
 			return False
 		
 		# Will the shards fit?
 		if node1.used + node2_shard.store > node1.capacity or node2.used + node1_shard.store > node2.capacity:
-			LOG.debug("Too big: %d >? {} and/or %d >? %d",
-				node1.used + node2_shard.store, node1.capacity, node2.used + node1_shard.store, node2.capacity)
+			if LOG.isEnabledFor(logging.DEBUG):
+				LOG.debug("Too big: %d >? %d and/or %d >? %d",
+					node1.used + node2_shard.store, node1.capacity, node2.used + node1_shard.store, node2.capacity)
 			return False
 		
-		# Check if node1_shard can be moved to node2 without violating the one shard per rack rule
-		for node in self.nodes_by_size:
-			# Ignore ourself, otherwise we'll conflict with ourself
-			if node is node1:
-				continue
-			# If the node we're checking is not on the same rack as the
-			# node we're moving to, it won't conflict
-			if node.rack != node2.rack:
-				continue
-			# Check if any shards in the node share the index and shard number.
-			# If found, a shard replica/primary is already located on the destination node's
-			# rack and we can't move.
-			for checking_shard in node.shards:
-				if node1_shard.index == checking_shard.index and \
-					node1_shard.shard == checking_shard.shard:
-					LOG.debug("Rack conflict: moving shard %s/%s/%s to node %s would conflict with shard %s/%s/%s on node %s",
-						node1_shard.index, node1_shard.shard, node1_shard.prirep,
-						node1.name,
-						checking_shard.index, checking_shard.shard, checking_shard.prirep,
-						node.name,
-					)
-					return False
-		# Same but for node2_shard to node1
-		for node in self.nodes_by_size:
-			if node is node2:
-				continue
-			if node.rack != node1.rack:
-				continue
-			for checking_shard in node.shards:
-				if node2_shard.index == checking_shard.index and \
-					node2_shard.shard == checking_shard.shard:
-					LOG.debug("Rack conflict: moving shard %s/%s/%s to node %s would conflict with shard %s/%s/%s on node %s",
-						node2_shard.index, node2_shard.shard, node2_shard.prirep,
-						node2.name,
-						checking_shard.index, checking_shard.shard, checking_shard.prirep,
-						node.name,
+		# Check if the shards can be moved without violating the one shard per rack rule.
+		# If another node on the destination's rack holds a copy of the shard, a replica/primary
+		# is already located on that rack and we can't move.
+		for shard, from_node, to_node in ((node1_shard, node1, node2), (node2_shard, node2, node1)):
+			conflict_name = self._rack_conflict(shard, from_node, to_node.rack)
+			if conflict_name is not None:
+				if LOG.isEnabledFor(logging.DEBUG):
+					LOG.debug("Rack conflict: moving shard %s/%s/%s to node %s would conflict with the copy on node %s",
+						shard.index, shard.shard, shard.prirep,
+						to_node.name,
+						conflict_name,
 					)
-					return False
+				return False
 		
 		return True
 	
+	def _rack_conflict(self, shard, from_node, to_rack):
+		"""
+		Gets the name of a node on `to_rack`, other than `from_node`, holding a copy of `shard`, or None
+		if moving `shard` off of `from_node` to that rack would not break the one shard per rack rule.
+		"""
+		for node_name in self.rack_index.get((to_rack, shard.index, shard.shard), ()):
+			# Ignore ourself, otherwise we'll conflict with ourself
+			if node_name != from_node.name:
+				return node_name
+		return None
+	
 	def plan_exchange(self, node1, node1_shard, node2, node2_shard):
 		"""
 		Adds move operations to exchange the two shards. Also updates the node's shards list.
 		"""
-		LOG.info("Exchanging shard %s/%s/%s (%s) on node %s (%.2f%%) with %s/%s/%s (%s) on node %s (%.2f%%)",
-			node1_shard.index, node1_shard.shard, node1_shard.prirep, format_bytes(node1_shard.store),
-			node1.name, sum(node.store for node in node1.shards) * 100 / node1.capacity,
-			node2_shard.index, node2_shard.shard, node2_shard.prirep, format_bytes(node2_shard.store),
-			node2.name, sum(node.store for node in node2.shards) * 100 / node2.capacity,
-		)
+		if LOG.isEnabledFor(logging.INFO):
+			LOG.info("Exchanging shard %s/%s/%s (%s) on node %s (%.2f%%) with %s/%s/%s (%s) on node %s (%.2f%%)",
+				node1_shard.index, node1_shard.shard, node1_shard.prirep, format_bytes(node1_shard.store),
+				node1.name, node1.fraction_used * 100,
+				node2_shard.index, node2_shard.shard, node2_shard.prirep, format_bytes(node2_shard.store),
+				node2.name, node2.fraction_used * 100,
+			)
 		
 		self.operations.append({
 			"move": {
@@ -337,43 +417,107 @@ class Plan:
 				"to_node": node1.name,
 			},
 		})
-		node1.shards.remove(node1_shard)
-		node1.shards.append(node2_shard)
-		node2.shards.remove(node2_shard)
-		node2.shards.append(node1_shard)
-		self.moved_shards.add((node1_shard.index, node1_shard.shard))
-		self.moved_shards.add((node2_shard.index, node2_shard.shard))
+		self.fraction_sum -= node1.fraction_used + node2.fraction_used
+		node1.remove_shard(node1_shard)
+		node1.add_shard(node2_shard)
+		node2.remove_shard(node2_shard)
+		node2.add_shard(node1_shard)
+		self.fraction_sum += node1.fraction_used + node2.fraction_used
+		self.rack_index[(node1.rack, node1_shard.index, node1_shard.shard)].discard(node1.name)
+		self.rack_index[(node2.rack, node1_shard.index, node1_shard.shard)].add(node2.name)
+		self.rack_index[(node2.rack, node2_shard.index, node2_shard.shard)].discard(node2.name)
+		self.rack_index[(node1.rack, node2_shard.index, node2_shard.shard)].add(node1.name)
+		self.moved_shards.add(node1_shard.key)
+		self.moved_shards.add(node2_shard.key)
+		self._movable_cache.clear()
 		self._sort()
 	
-	def percent_used_variance(self, exclude_shards=[], include_shards=[]):
+	def exchange_variance_delta(self, node1, node1_shard, node2, node2_shard):
+		"""
+		Computes how much the variance of the percent disk used would change if the two shards were exchanged.
+		
+		Negative values mean the exchange makes things more even. Only the two affected nodes are looked at,
+		so this is much cheaper than calling `percent_used_variance` before and after.
+		"""
+		count = len(self.nodes_by_size)
+		old1 = node1.fraction_used
+		old2 = node2.fraction_used
+		new1 = (node1.used - node1_shard.store + node2_shard.store) / node1.capacity
+		new2 = (node2.used - node2_shard.store + node1_shard.store) / node2.capacity
+		# Written in terms of the differences so that a no-op exchange is exactly 0
+		diff1 = new1 - old1
+		diff2 = new2 - old2
+		diff_sum = diff1 + diff2
+		return (diff1 * (new1 + old1) + diff2 * (new2 + old2)) / count - \
+			diff_sum * (2 * self.fraction_sum + diff_sum) / (count * count)
+	
+	def percent_used_variance(self, exclude_shards=(), include_shards=()):
 		"""
 		Gets the variance of the percent disk used
 		
 		Optionally exclude or include shards in the computation, for seeing if a
 		configuration is better without actually committing to it
 		"""
-		def percentage(node):
-			the_sum = node.used
-			for exclude_node, exclude_shard in exclude_shards:
-				if exclude_node is node:
-					the_sum -= exclude_shard.store
-			for include_node, include_shard in include_shards:
-				if include_node is node:
-					the_sum += include_shard.store
-			
-			return the_sum / node.capacity
-		return statistics.pvariance(percentage(node) for node in self.nodes_by_size)
+		# Net change in used bytes per node, so each node is only looked up once
+		adjustments = {}
+		for exclude_node, exclude_shard in exclude_shards:
+			adjustments[exclude_node] = adjustments.get(exclude_node, 0) - exclude_shard.store
+		for include_node, include_shard in include_shards:
+			adjustments[include_node] = adjustments.get(include_node, 0) + include_shard.store
+		
+		# Plain float arithmetic; `statistics.pvariance` does exact fraction math, which is much slower
+		fractions = [
+			(node.used + adjustments[node]) / node.capacity if node in adjustments else node.fraction_used
+			for node in self.nodes_by_size
+		]
+		mean = sum(fractions) / len(fractions)
+		return sum((fraction - mean) ** 2 for fraction in fractions) / len(fractions)
 	
-	def exec(self, dry_run=True):
+	def exec(self, dry_run=True, batch_size=None):
 		"""
 		Executes the operations enqueued with `plan_step`.
 		
 		This submits the operations to Elasticsearch, which will execute them asynchronously.
 		As such, this method returns quickly and without waiting for the moves to finish.
+		
+		If `batch_size` is given, the operations are submitted in concurrent requests of that many
+		exchanges each, instead of in one request. Dry runs always use a single request. Moves that ES
+		has accepted can't be undone, so if some batches fail, only their operations are kept in
+		`operations` and the error is re-raised.
+		"""
+		if batch_size is not None and batch_size < 1:
+			raise ValueError("batch_size must be at least 1, got %r" % (batch_size,))
+		if dry_run or batch_size is None:
+			self._reroute(self.operations, dry_run)
+			self.operations.clear()
+			return
+		
+		# Each exchange is two moves, keep them in the same batch
+		batch_len = batch_size * 2
+		batches = [self.operations[i:i+batch_len] for i in range(0, len(self.operations), batch_len)]
+		with ThreadPoolExecutor(max_workers=4) as executor:
+			futures = [executor.submit(self._reroute, batch, dry_run) for batch in batches]
+		
+		failed_operations = []
+		error = None
+		for batch, future in zip(batches, futures):
+			try:
+				future.result()
+			except TransportError as err:
+				failed_operations.extend(batch)
+				error = err
+		if error is not None:
+			LOG.error("%d of %d move(s) failed to submit", len(failed_operations), len(self.operations))
+			self.operations[:] = failed_operations
+			raise error
+		self.operations.clear()
+	
+	def _reroute(self, operations, dry_run):
+		"""
+		Submits a reroute request to ES for the operations, logging ES's error info on failure.
 		"""
 		try:
-			self.es.cluster.reroute(body={"commands": self.operations}, dry_run=dry_run)
+			self.es.cluster.reroute(body={"commands": operations}, dry_run=dry_run)
 		except TransportError as err:
 			LOG.error("ES error info: \n%s", pprint.pformat(err.info))
 			raise
-		self.operations.clear()
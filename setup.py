@@ -16,5 +16,8 @@ setup(
 	},
 	install_requires=[
 		"elasticsearch6<7.0.0,>=6.0.0"
-	]
+	],
+	extras_require={
+		"orjson": ["orjson"],
+	},
 )